@@ -8,6 +8,7 @@ import requests
 import os
 import time # Added for progress reporting
 import math # Added for progress reporting
+from contextlib import aclosing # Stop the splitter if an upload fails mid-way
 
 # Import framework types
 from pyrogram import Client
@@ -19,7 +20,7 @@ from telegram.error import BadRequest as PTBBadRequest, RetryAfter
 
 # Import local helpers/config
 from upload import upload_file_pyrogram
-from utils import clean_filename, split_if_needed, cleanup_split_parts
+from utils import clean_filename, iter_split_parts, cleanup_split_parts
 
 logger = logging.getLogger(__name__)
 
@@ -82,6 +83,26 @@ async def _edit_download_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: i
     except Exception as e: logger.error(f"Unexpected DL Prog Edit Error: {e}", exc_info=False)
 
 
+# --- Split & Upload Helper ---
+async def _split_and_upload(full_file_path: str, file_name: str, update: Update, context: ContextTypes.DEFAULT_TYPE, pyrogram_client: Client):
+    """Uploads each part as soon as the splitter produces it (upload overlaps ffmpeg). Returns bool success."""
+    delete_after_upload = context.bot_data.get('delete_after_upload', True)
+    parts = []; all_ok = True; split_plan = {}
+    async with aclosing(iter_split_parts(full_file_path, context, update.effective_chat.id, split_plan)) as split_parts:
+        async for part_path in split_parts:
+            if part_path is None: all_ok = False; break # Split failed (already reported to the user)
+            parts.append(part_path)
+            total = split_plan.get('total_parts') # Known for keyframe-planned splits only
+            if part_path == full_file_path: part_cap = file_name
+            elif total and len(parts) <= total: part_cap = f"{file_name} (Part {len(parts)}/{total})"
+            else: part_cap = f"{file_name} (Part {len(parts)})"
+            upload_ok = await upload_file_pyrogram(pyrogram_client, update, context, part_path, part_cap)
+            if not upload_ok: all_ok = False; break
+    if not parts: return False
+    if delete_after_upload and all_ok: await cleanup_split_parts(full_file_path, parts)
+    return all_ok
+
+
 # --- nzbCloud Downloader ---
 async def download_files_nzbcloud(urls, filenames, cf_clearance, update: Update, context: ContextTypes.DEFAULT_TYPE, pyrogram_client: Client):
     """ Downloads nzb files with progress, splits, uploads. """
@@ -90,7 +111,6 @@ async def download_files_nzbcloud(urls, filenames, cf_clearance, update: Update,
     failed_sources = []
     chat_id = update.effective_chat.id
     download_dir = context.bot_data.get('download_dir', '/content/downloads')
-    delete_after_upload = context.bot_data.get('delete_after_upload', True)
 
     for idx, (url, file_name) in enumerate(zip(urls, filenames)):
         url, file_name = url.strip(), file_name.strip()
@@ -158,19 +178,10 @@ async def download_files_nzbcloud(urls, filenames, cf_clearance, update: Update,
             # Clean up chat_data marker
             if status_message_id: context.chat_data.pop(f'dl_status_msg_{status_message_id}', None)
 
-        # --- Splitting & Upload Step (Unchanged from previous version) ---
+        # --- Splitting & Upload Step ---
         if download_success:
-            parts = await split_if_needed(full_file_path, context, chat_id)
-            if parts:
-                all_ok = True; total = len(parts)
-                for i, part_path in enumerate(parts):
-                    part_cap = f"{file_name} (Part {i+1}/{total})" if total > 1 else file_name
-                    upload_ok = await upload_file_pyrogram(pyrogram_client, update, context, part_path, part_cap)
-                    if not upload_ok: all_ok = False; break
-                if delete_after_upload and parts and all_ok: await cleanup_split_parts(full_file_path, parts)
-                if not all_ok and url not in failed_sources: failed_sources.append(url)
-            else:
-                 if url not in failed_sources: failed_sources.append(url)
+            all_ok = await _split_and_upload(full_file_path, file_name, update, context, pyrogram_client)
+            if not all_ok and url not in failed_sources: failed_sources.append(url)
         # --- End Splitting & Upload Step ---
 
     return failed_sources
@@ -180,7 +191,7 @@ async def download_file_deltaleech(url, file_name, cf_clearance, update: Update,
     """ Downloads single Delta file with progress, splits, uploads. Returns bool success."""
     cookies = {"cf_clearance": cf_clearance} if cf_clearance else {}; headers = {"User-Agent": "Mozilla/5.0", "Referer": url}
     chat_id = update.effective_chat.id; file_name = clean_filename(file_name)
-    download_dir = context.bot_data.get('download_dir', '/content/downloads'); delete_after_upload = context.bot_data.get('delete_after_upload', True)
+    download_dir = context.bot_data.get('download_dir', '/content/downloads')
     full_file_path = os.path.join(download_dir, file_name); download_success = False
     status_message = None; status_message_id = None
 
@@ -225,18 +236,9 @@ async def download_file_deltaleech(url, file_name, cf_clearance, update: Update,
         if response: response.close()
         if status_message_id: context.chat_data.pop(f'dl_status_msg_{status_message_id}', None)
 
-    # --- Splitting & Upload Step (Unchanged) ---
+    # --- Splitting & Upload Step ---
     if download_success:
-        parts = await split_if_needed(full_file_path, context, chat_id)
-        if parts:
-            all_ok = True; total = len(parts)
-            for i, part_path in enumerate(parts):
-                part_cap = f"{file_name} (Part {i+1}/{total})" if total > 1 else file_name
-                upload_ok = await upload_file_pyrogram(pyrogram_client, update, context, part_path, part_cap)
-                if not upload_ok: all_ok = False; break
-            if delete_after_upload and parts and all_ok: await cleanup_split_parts(full_file_path, parts)
-            return all_ok
-        else: return False # Splitting failed
+        return await _split_and_upload(full_file_path, file_name, update, context, pyrogram_client)
     else: return False # Download failed
 
 async def download_multiple_files_deltaleech(urls, file_names, cf_clearance, update: Update, context: ContextTypes.DEFAULT_TYPE, pyrogram_client: Client):
@@ -257,7 +259,7 @@ async def download_file_bitso(url, file_name, referer_url, id_cookie, sess_cooki
     if id_cookie: cookies["_identity"] = id_cookie
     if sess_cookie: cookies["PHPSESSID"] = sess_cookie
     chat_id = update.effective_chat.id; file_name = clean_filename(file_name)
-    download_dir = context.bot_data.get('download_dir', '/content/downloads'); delete_after_upload = context.bot_data.get('delete_after_upload', True)
+    download_dir = context.bot_data.get('download_dir', '/content/downloads')
     full_file_path = os.path.join(download_dir, file_name); download_success = False
     status_message = None; status_message_id = None
 
@@ -302,18 +304,9 @@ async def download_file_bitso(url, file_name, referer_url, id_cookie, sess_cooki
         if response: response.close()
         if status_message_id: context.chat_data.pop(f'dl_status_msg_{status_message_id}', None)
 
-    # --- Splitting & Upload Step (Unchanged) ---
+    # --- Splitting & Upload Step ---
     if download_success:
-        parts = await split_if_needed(full_file_path, context, chat_id)
-        if parts:
-            all_ok = True; total = len(parts)
-            for i, part_path in enumerate(parts):
-                part_cap = f"{file_name} (Part {i+1}/{total})" if total > 1 else file_name
-                upload_ok = await upload_file_pyrogram(pyrogram_client, update, context, part_path, part_cap)
-                if not upload_ok: all_ok = False; break
-            if delete_after_upload and parts and all_ok: await cleanup_split_parts(full_file_path, parts)
-            return all_ok
-        else: return False # Splitting failed
+        return await _split_and_upload(full_file_path, file_name, update, context, pyrogram_client)
     else: return False # Download failed
 
 async def download_multiple_files_bitso(urls, file_names, referer_url, id_cookie, sess_cookie, update: Update, context: ContextTypes.DEFAULT_TYPE, pyrogram_client: Client):
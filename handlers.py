@@ -240,5 +240,9 @@ conv_handler = ConversationHandler(
     ],
 )
 
+# Update kinds the handlers above (plus /start and /cancel) actually consume.
+# Pass to start_polling(allowed_updates=ALLOWED_UPDATES) so Telegram doesn't ship anything else.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # Print success message for Colab %%writefile magic
 print("handlers.py written successfully with simplified cancel.")
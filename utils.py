@@ -8,14 +8,29 @@ import logging
 import math
 import asyncio # For sleep and subprocess
 import subprocess # For running ffmpeg/ffprobe
-import glob # To find created parts
 import json # To parse ffprobe output
+import struct # To read MP4/MKV header fields
+import tempfile # To spool long ffmpeg stderr to disk
+import shutil # To remove split part directories
+import sys # rmtree error hook name depends on the Python version
+from collections import OrderedDict # LRU cache of probe results
+from contextlib import aclosing # To close the split generator when the consumer stops early
+from dataclasses import dataclass
+try: import orjson # Optional: faster parsing of ffprobe JSON
+except ImportError: orjson = None
 
 # Need ContextTypes for type hinting
 from telegram.ext import ContextTypes
 
 logger = logging.getLogger(__name__)
 
+_json_loads = orjson.loads if orjson else json.loads # Both accept raw bytes
+
+# Precompiled patterns for the filename helpers (called once per URL/filename)
+_BAD_CHAR_RUNS_RE = re.compile(r'[\\/:*?"<>|\[\]_]+') # Invalid chars and underscores: each run becomes one '_'
+_DOT_SEPARATORS_RE = re.compile(r'[ _-]+')
+_DOTS_RE = re.compile(r'\.+')
+
 # --- Constants ---
 SPLIT_CHECK_SIZE = 1950 * 1024 * 1024 # Approx 1.95 GiB limit check before attempting split
 TARGET_SPLIT_SIZE_MB = 1800 # Target for calculation (used by dynamic duration)
@@ -23,59 +38,313 @@ TARGET_SPLIT_SIZE_BYTES = TARGET_SPLIT_SIZE_MB * 1024 * 1024
 
 VIDEO_EXTENSIONS = {".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv", ".wmv", ".mpeg", ".mpg"}
 FFMPEG_SEGMENT_DURATION = 900 # Default 15 mins for fixed-time split attempt (Adjust if needed)
+FAST_PROBE_HEAD_SIZE = 256 * 1024 # Bytes read from the file head when looking for the MKV Info element
+SINGLE_PART_TOLERANCE = 1 << 20 # A lone part within 1 MiB of the original is treated as the original
+FFPROBE_CACHE_SIZE = 128 # Probe results kept in bot_data['ffprobe_cache'] (LRU)
+FFMPEG_ERROR_TAIL_BYTES = 8 * 1024 # How much of the spooled ffmpeg stderr to report on failure
+PROCESS_STOP_TIMEOUT = 5 # Seconds a cancelled ffmpeg/ffprobe gets to exit on SIGTERM before it is killed
+START_PTS_PACKETS = 64 # Leading packets scanned for the earliest pts (ffmpeg's output time zero, see _plan_cut_points)
+SEGMENT_TIME_DELTA = b"0.05" # -segment_time_delta: slack so rounding can't push a planned keyframe past its cut time
+CUT_SIZE_FACTOR = 0.95 # Planned parts hold at most 95% of TARGET_SPLIT_SIZE_BYTES of packets, leaving room for container overhead
+PACKET_PROBE_READ_SIZE = 1 << 16 # Bytes read per chunk from the streamed ffprobe packet listing
+SPLIT_CONCURRENCY = min(4, os.cpu_count() or 2) # Default split_many fan-out (stream copy is mostly disk-bound)
+FFMPEG_CONCURRENCY = max(1, os.cpu_count() or 2) # Max ffmpeg processes at once: one core each
+FFPROBE_CONCURRENCY = 4 * FFMPEG_CONCURRENCY # Header-only ffprobe is short-lived, but still a fork+exec each
+
+# Shared by every split/probe, whichever download started it
+_FFMPEG_SEM = asyncio.Semaphore(FFMPEG_CONCURRENCY) # Full-file passes: ffmpeg jobs and the ffprobe packet scan
+_FFPROBE_SEM = asyncio.Semaphore(FFPROBE_CONCURRENCY)
+
+# Pre-encoded static argv prefixes (exec would fsencode every str argument on each call)
+FFMPEG_BASE = (b"ffmpeg", b"-hide_banner", b"-loglevel", b"warning")
+FFPROBE_BASE = (b"ffprobe", b"-v", b"quiet", b"-print_format", b"json", b"-show_entries", b"format=bit_rate,duration")
+# Header-only: stop probing after 32K / one packet (the JSON fallback below is unconstrained)
+FFPROBE_FORMAT_BASE = (b"ffprobe", b"-v", b"quiet", b"-probesize", b"32K", b"-analyzeduration", b"0", b"-read_intervals", b"%+#1",
+                       b"-show_entries", b"format=bit_rate,duration", b"-of", b"default=noprint_wrappers=1")
+# Run ffmpeg at lower CPU/IO priority so the bot's event loop (uploads, Telegram keep-alives) stays responsive.
+# Done with argv wrappers rather than preexec_fn, which would force a slow fork+exec for every spawn.
+FFMPEG_NICE = 10
+FFMPEG_PRIORITY_PREFIX = ((b"nice", b"-n", str(FFMPEG_NICE).encode()) if shutil.which("nice") else ()) + \
+                         ((b"ionice", b"-t", b"-c2", b"-n7") if shutil.which("ionice") else ()) # -t: run anyway if ioprio_set is refused
+FFPROBE_PACKETS_BASE = (b"ffprobe", b"-v", b"error", b"-show_entries", b"packet=codec_type,stream_index,pts_time,size,flags", b"-of", b"csv=p=0")
+
+
+@dataclass(frozen=True, slots=True)
+class _FInfo:
+    """Path pieces, size and mtime of a file being split, computed once and passed down."""
+    path: str
+    base: str
+    ext: str
+    size: int
+    mtime: float
 
 
 # --- Helper to run FFmpeg/FFprobe commands ---
-async def _run_command(cmd_list, command_name="command"):
-    """Runs an external command asynchronously, logs output, returns success(bool), output(str)."""
-    cmd_str = " ".join(map(str, cmd_list))
-    logger.info(f"Running {command_name}: {cmd_str}")
+def _cmd_str(cmd_list):
+    """Printable form of a str/bytes argv, for logging."""
+    return " ".join(os.fsdecode(c) for c in cmd_list)
+
+
+async def _stop_process(process):
+    """Stops a child that is still running (cancellation or error): SIGTERM first (ffmpeg closes its current
+    output cleanly), SIGKILL if it hasn't exited within PROCESS_STOP_TIMEOUT. Always reaps it, so no zombie
+    or stray writer is left behind. Does nothing if the process has already exited."""
+    if process.returncode is not None: return
+    try: process.terminate()
+    except ProcessLookupError: pass
+    try: await asyncio.wait_for(process.wait(), timeout=PROCESS_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        try: process.kill()
+        except ProcessLookupError: pass
+        await process.wait()
+
+
+async def _run_command(cmd_list, command_name="command", capture_stderr=True):
+    """Runs an external command asynchronously, logs output. Pass capture_stderr=False for commands that
+    are silenced anyway (e.g. ffprobe -v quiet) to skip the stderr pipe.
+    Returns success(bool), output: raw stdout bytes on success, decoded stderr(str) on failure."""
+    if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Running {command_name}: {_cmd_str(cmd_list)}")
     process = await asyncio.create_subprocess_exec(
         *cmd_list,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+        stderr=asyncio.subprocess.PIPE if capture_stderr else asyncio.subprocess.DEVNULL
     )
-    stdout, stderr = await process.communicate()
+    try: stdout, stderr = await process.communicate()
+    finally: await _stop_process(process) # No-op once it has exited; on cancel/error don't leave it running
     return_code = process.returncode
 
-    output = stdout.decode('utf-8', errors='replace').strip()
-    error_output = stderr.decode('utf-8', errors='replace').strip()
-
     if return_code != 0:
-        logger.error(f"{command_name} failed (code {return_code}):\n{cmd_str}\nError:\n{error_output}")
+        error_output = stderr.decode('utf-8', errors='replace').strip() if stderr else ''
+        logger.error(f"{command_name} failed (code {return_code}):\n{_cmd_str(cmd_list)}\nError:\n{error_output}")
         return False, error_output
+    # Success: stdout stays raw bytes, stderr is only decoded if INFO logging will show it
+    if stderr and logger.isEnabledFor(logging.INFO): logger.info("%s stderr output:\n%s", command_name, stderr.decode('utf-8', errors='replace').strip())
+    logger.info("%s command finished successfully.", command_name)
+    return True, stdout
+
+
+async def _run_ffmpeg_command(cmd_list, stdout_queue=None):
+    """Runs a long ffmpeg job with stderr spooled to a temp file, so a busy event loop can't stall it
+    on a full pipe. If stdout_queue is given, each stdout line is put on it as ffmpeg prints it.
+    Returns success(bool), tail of stderr(str) on failure."""
+    async with _FFMPEG_SEM: # Bound concurrent ffmpeg jobs across all downloads
+        if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Running ffmpeg: {_cmd_str(cmd_list)}")
+        with tempfile.TemporaryFile() as err_file:
+            process = await asyncio.create_subprocess_exec(*FFMPEG_PRIORITY_PREFIX, *cmd_list, stderr=err_file,
+                                                           stdout=asyncio.subprocess.PIPE if stdout_queue else asyncio.subprocess.DEVNULL)
+            try:
+                if stdout_queue:
+                    async for line in process.stdout: stdout_queue.put_nowait(line.rstrip(b'\r\n'))
+                return_code = await process.wait()
+            finally: await _stop_process(process) # No-op once it has exited; on cancel/error don't leave it running
+            if return_code != 0:
+                err_size = err_file.seek(0, os.SEEK_END); err_file.seek(max(0, err_size - FFMPEG_ERROR_TAIL_BYTES))
+                error_output = err_file.read().decode('utf-8', errors='replace').strip()
+                logger.error(f"ffmpeg failed (code {return_code}):\n{_cmd_str(cmd_list)}\nError (last {FFMPEG_ERROR_TAIL_BYTES} bytes):\n{error_output}")
+                return False, error_output
+    logger.info("ffmpeg command finished successfully.")
+    return True, None
+
+
+# --- In-process container header probe (avoids spawning ffprobe) ---
+def _mp4_duration(f, file_size):
+    """Walks top-level MP4/MOV boxes to moov->mvhd and returns duration in seconds, or None."""
+    def find_box(start, end, wanted):
+        pos = start
+        while pos + 8 <= end:
+            f.seek(pos); header = f.read(16)
+            if len(header) < 8: return None
+            size, box_type = struct.unpack(">I4s", header[:8]); header_len = 8
+            if size == 1:
+                if len(header) < 16: return None
+                size = struct.unpack(">Q", header[8:16])[0]; header_len = 16
+            elif size == 0: size = end - pos # Box extends to end of parent
+            if size < header_len: return None
+            if box_type == wanted: return pos + header_len, pos + size
+            pos += size
+        return None
+
+    moov = find_box(0, file_size, b"moov")
+    if not moov: return None
+    mvhd = find_box(moov[0], moov[1], b"mvhd")
+    if not mvhd: return None
+    f.seek(mvhd[0]); data = f.read(32)
+    if len(data) < 20: return None
+    if data[0] == 1: # Version 1: 64-bit creation/modification times and duration
+        if len(data) < 32: return None
+        timescale, duration = struct.unpack(">IQ", data[20:32])
     else:
-        if error_output: logger.info(f"{command_name} stderr output:\n{error_output}") # Log potential warnings/info
-        logger.info(f"{command_name} command finished successfully.")
-        return True, output
+        timescale, duration = struct.unpack(">II", data[12:20])
+    return duration / timescale if timescale and duration else None
+
+
+def _ebml_vint(buf, pos, keep_marker):
+    """Reads an EBML variable-length integer. Returns (value, next_pos, is_unknown_size) or None."""
+    if pos >= len(buf) or buf[pos] == 0: return None
+    first = buf[pos]; length = 8 - first.bit_length() + 1
+    if pos + length > len(buf): return None
+    value = first if keep_marker else first & ((1 << (8 - length)) - 1)
+    for b in buf[pos + 1:pos + length]: value = (value << 8) | b
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _mkv_duration(head):
+    """Finds Segment->Info->Duration in the head of an MKV/WebM file and returns seconds, or None."""
+    pos = 0; end = len(head); timecode_scale = 1000000; duration = None; in_info = False
+    while pos < end:
+        element_id = _ebml_vint(head, pos, keep_marker=True)
+        if not element_id: return None
+        element_id, pos, _ = element_id
+        element_size = _ebml_vint(head, pos, keep_marker=False)
+        if not element_size: return None
+        size, pos, unknown = element_size
+        if element_id == 0x18538067: continue # Segment: descend into children
+        if element_id == 0x1549A966: # Info: descend, stop at its end
+            in_info = True; end = len(head) if unknown else min(len(head), pos + size); continue
+        if element_id == 0x1F43B675: break # Cluster: media data starts, Info was not found before it
+        if in_info and element_id == 0x2AD7B1: # TimestampScale (ns per tick)
+            timecode_scale = int.from_bytes(head[pos:pos + size], "big") or timecode_scale
+        elif in_info and element_id == 0x4489: # Duration (float, in ticks)
+            if size == 4: duration = struct.unpack(">f", head[pos:pos + 4])[0]
+            elif size == 8: duration = struct.unpack(">d", head[pos:pos + 8])[0]
+        if unknown: return None
+        pos += size
+    return duration * timecode_scale / 1e9 if duration and duration > 0 else None
+
+
+def _fast_probe(path, file_size):
+    """Reads bitrate/duration straight from MP4/MOV or MKV/WebM headers. Returns (bitrate_bps, duration_s) or None."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(FAST_PROBE_HEAD_SIZE)
+            if head[:4] == b"\x1a\x45\xdf\xa3": duration = _mkv_duration(head)
+            elif head[4:8] == b"ftyp": duration = _mp4_duration(f, file_size)
+            else: return None
+    except Exception as e:
+        logger.debug(f"Fast probe failed for {path}: {e}"); return None
+    if not duration or duration <= 0: return None
+    return file_size * 8 / duration, duration
+
+
+# --- FFprobe bitrate/duration ---
+async def _ffprobe_bitrate_duration(path):
+    """Asks ffprobe for just format bit_rate/duration as key=value lines from a header-only probe, falling
+    back to a full (unconstrained) JSON probe of the same two fields if that output is unusable.
+    Returns (bitrate, duration); either may be None."""
+    async with _FFPROBE_SEM: success, output = await _run_command(FFPROBE_FORMAT_BASE + (os.fsencode(path),), "ffprobe", capture_stderr=False)
+    if success and output:
+        try:
+            fields = dict(line.split(b'=', 1) for line in output.splitlines() if b'=' in line)
+            return float(fields[b'bit_rate']), float(fields[b'duration'])
+        except (KeyError, ValueError) as e: logger.warning(f"Flat ffprobe output unusable ({e!r}). Retrying with JSON.")
 
+    bitrate = None; duration = None
+    async with _FFPROBE_SEM: success, output = await _run_command(FFPROBE_BASE + (os.fsencode(path),), "ffprobe", capture_stderr=False)
+    if success and output:
+        try:
+            video_info = _json_loads(output)
+            if 'format' in video_info and 'bit_rate' in video_info['format']: bitrate = float(video_info["format"]["bit_rate"])
+            if 'format' in video_info and 'duration' in video_info['format']: duration = float(video_info["format"]["duration"])
+        except Exception as json_e: logger.error(f"Failed to parse ffprobe JSON: {json_e}")
+    return bitrate, duration
 
-# --- Video Splitting using FFmpeg (Dynamic Duration) ---
-async def _split_video_dynamic_duration(original_path, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None):
-    """Splits a video file into segments using calculated duration based on bitrate."""
-    base_filename = os.path.basename(original_path)
-    _ , file_ext = os.path.splitext(base_filename)
-    download_dir = context.bot_data.get('download_dir', '/content/downloads') if context else '/content/downloads'
 
-    # 1. Get Bitrate using ffprobe
-    logger.info(f"Getting bitrate for {base_filename} using ffprobe...")
-    ffprobe_cmd = ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", original_path]
-    probe_success, probe_output = await _run_command(ffprobe_cmd, "ffprobe")
+async def _probe_cached(finfo: _FInfo, context: ContextTypes.DEFAULT_TYPE | None):
+    """Bitrate/duration from container headers, falling back to ffprobe. Successful results are kept in
+    bot_data['ffprobe_cache'] keyed by (path, mtime, size), so a file is probed once per version."""
+    cache = context.bot_data.setdefault('ffprobe_cache', OrderedDict()) if context else None
+    key = (finfo.path, finfo.mtime, finfo.size)
+    if cache is not None and key in cache:
+        cache.move_to_end(key); logger.info(f"Using cached probe for {finfo.base}"); return cache[key]
 
-    bitrate = None; duration_from_probe = None
-    if probe_success and probe_output:
+    fast_info = await asyncio.to_thread(_fast_probe, finfo.path, finfo.size)
+    if fast_info:
+        bitrate, duration = fast_info
+        logger.info(f"Read bitrate from container header: {bitrate:.0f} bps, duration {duration:.1f}s")
+    else:
+        logger.info(f"Getting bitrate for {finfo.base} using ffprobe...")
+        bitrate, duration = await _ffprobe_bitrate_duration(finfo.path)
+        if bitrate: logger.info(f"Detected bitrate: {bitrate} bps")
+        else: logger.warning("Bitrate not found in ffprobe output."); return bitrate, duration
+
+    if cache is not None:
+        cache[key] = (bitrate, duration)
+        while len(cache) > FFPROBE_CACHE_SIZE: cache.popitem(last=False)
+    return bitrate, duration
+
+
+# --- Keyframe-aligned cut planning ---
+async def _plan_cut_points(path):
+    """Picks -segment_times cut points from real packet sizes, streamed from ffprobe as it reads the file.
+    Packets of all streams are bucketed into GOPs, delimited by keyframes of the first video stream (the segment
+    muxer's reference stream, the only one it cuts on); when the next GOP would push a part past
+    TARGET_SPLIT_SIZE_BYTES * CUT_SIZE_FACTOR, a new part starts at that GOP's keyframe.
+    Without -copyts ffmpeg shifts output timestamps so the file starts at 0, and the segment muxer compares
+    -segment_times against those, so cuts are returned relative to the earliest pts. Returns time strings, or None."""
+    cmd = FFPROBE_PACKETS_BASE + (os.fsencode(path),)
+    if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Running ffprobe packets: {_cmd_str(cmd)}")
+    cut_limit = TARGET_SPLIT_SIZE_BYTES * CUT_SIZE_FACTOR
+    cut_points = []; part_bytes = 0; gop_bytes = 0; gop_start = None; pending = b''; eof = False
+    start_pts = None; start_packets = 0; ref_stream = None
+    async with _FFMPEG_SEM: # Demuxes the whole file, as heavy on the disk as the split itself
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
         try:
-            video_info = json.loads(probe_output)
-            if 'format' in video_info and 'bit_rate' in video_info['format']: bitrate = float(video_info["format"]["bit_rate"])
-            if 'format' in video_info and 'duration' in video_info['format']: duration_from_probe = float(video_info["format"]["duration"])
-            if bitrate: logger.info(f"Detected bitrate: {bitrate} bps")
-            else: logger.warning("Bitrate not found in ffprobe output.")
-        except Exception as json_e: logger.error(f"Failed to parse ffprobe JSON: {json_e}")
+            while not eof:
+                chunk = await process.stdout.read(PACKET_PROBE_READ_SIZE)
+                eof = not chunk
+                lines = (pending + chunk).split(b'\n'); pending = b'' if eof else lines.pop()
+                for line in lines:
+                    fields = line.split(b',')
+                    if len(fields) < 5: continue
+                    codec_type, stream_index, pts_time, size, flags = fields[:5]
+                    if start_packets < START_PTS_PACKETS and pts_time != b'N/A':
+                        start_packets += 1; pts = float(pts_time)
+                        if start_pts is None or pts < start_pts: start_pts = pts
+                    if codec_type == b'video' and stream_index != ref_stream and (ref_stream is None or int(stream_index) < int(ref_stream)):
+                        ref_stream = stream_index # Lowest-index video stream seen so far
+                    if stream_index == ref_stream and b'K' in flags and pts_time != b'N/A':
+                        # A GOP just ended: it opens a new part if it doesn't fit in the current one
+                        if part_bytes and part_bytes + gop_bytes > cut_limit: cut_points.append(gop_start); part_bytes = 0
+                        part_bytes += gop_bytes; gop_bytes = 0; gop_start = pts_time
+                    if size.isdigit(): gop_bytes += int(size)
+            return_code = await process.wait()
+        finally: await _stop_process(process) # No-op once it has exited; on cancel/error don't leave it running
+    if return_code != 0:
+        logger.error(f"ffprobe packets failed (Code: {return_code})"); return None
+    if part_bytes and part_bytes + gop_bytes > cut_limit: cut_points.append(gop_start) # Last GOP
+    start_pts = start_pts or 0.0
+    return [f"{float(pts) - start_pts:.6f}" for pts in cut_points]
+
+
+# --- Video Splitting using FFmpeg (Dynamic Duration) ---
+def _near_size(path, size):
+    """True if path's size is within SINGLE_PART_TOLERANCE of size (or can't be read)."""
+    try: return abs(os.stat(path).st_size - size) < SINGLE_PART_TOLERANCE
+    except OSError: return True
+
+
+async def _send_quietly(context, chat_id, text):
+    """Best-effort status message; errors are ignored (so it can run as a background task)."""
+    if context and chat_id:
+        try: await context.bot.send_message(chat_id, text)
+        except Exception: pass
+
+
+async def _split_video_dynamic_duration(finfo: _FInfo, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None, split_plan: dict | None = None):
+    """Splits a video file into segments at keyframes planned from real packet sizes (_plan_cut_points), falling
+    back to a fixed -segment_time derived from the bitrate when no plan is available.
+    Async generator: yields each part as soon as ffmpeg has finished writing it, or None if the split fails."""
+    original_path, base_filename, file_ext = finfo.path, finfo.base, finfo.ext
+    download_dir = context.bot_data.get('download_dir', '/content/downloads') if context else '/content/downloads'
+
+    # 1. Get Bitrate (cached per file version, see _probe_cached)
+    bitrate, duration_from_probe = await _probe_cached(finfo, context)
 
     if bitrate is None or bitrate <= 0:
         logger.warning(f"Cannot perform size-based split for {base_filename} (bitrate={bitrate}). Aborting split.")
         if context and chat_id: await context.bot.send_message(chat_id, f"⚠️ Cannot determine video bitrate for '{base_filename}'. Cannot split by size.")
-        return None
+        yield None; return
 
     # 2. Calculate Segment Duration
     target_size_bits = TARGET_SPLIT_SIZE_BYTES * 8
@@ -84,118 +353,182 @@ async def _split_video_dynamic_duration(original_path, context: ContextTypes.DEF
     logger.info(f"Calculated target segment duration: {segment_duration} seconds (aiming for ~{TARGET_SPLIT_SIZE_MB}MB)")
 
     if duration_from_probe and segment_duration >= duration_from_probe:
-        logger.info("Calculated duration >= total duration. No split needed."); return [original_path]
+        logger.info("Calculated duration >= total duration. No split needed."); yield original_path; return
+
+    # Send the notice while the packet probe runs instead of waiting on the Telegram round trip first
+    msg_task = asyncio.create_task(_send_quietly(context, chat_id, f"✂️ Splitting video '{base_filename}'..."))
+
+    # 3. Plan keyframe cut points from actual packet sizes (bitrate duration is the fallback)
+    cut_points = await _plan_cut_points(original_path)
+    if cut_points:
+        logger.info(f"Planned {len(cut_points) + 1} parts at keyframes: {cut_points}")
+        if split_plan is not None: split_plan['total_parts'] = len(cut_points) + 1
+        split_args = (b'-segment_times', ','.join(cut_points).encode(), b'-segment_time_delta', SEGMENT_TIME_DELTA)
+    else:
+        logger.warning(f"No keyframe cut points for {base_filename}. Using fixed {segment_duration}s segments.")
+        split_args = (b'-segment_time', str(segment_duration).encode())
 
-    # 3. Prepare FFmpeg split command
+    # 4. Prepare FFmpeg split command
     parts_dir = os.path.join(download_dir, base_filename + "_parts")
     os.makedirs(parts_dir, exist_ok=True)
-    output_pattern = os.path.join(parts_dir, f"{base_filename}_part%03d{file_ext}")
-    cmd = ['ffmpeg','-hide_banner','-loglevel','info','-i',original_path,'-c','copy','-map','0','-segment_time',str(segment_duration),'-f','segment','-reset_timestamps','1',output_pattern]
-
+    output_pattern = os.path.join(parts_dir, f"{base_filename}_part%05d{file_ext}")
+    cmd = FFMPEG_BASE + (b'-i', os.fsencode(original_path), b'-c', b'copy', b'-map', b'0', *split_args,
+                         b'-f', b'segment', b'-reset_timestamps', b'1', b'-segment_list_type', b'flat', b'-segment_list', b'pipe:1',
+                         os.fsencode(output_pattern))
+    await msg_task
     logger.info(f"Starting ffmpeg video split for: {base_filename}")
-    if context and chat_id:
-        try: await context.bot.send_message(chat_id, f"✂️ Splitting video '{base_filename}'...")
-        except Exception: pass
-
-    # 4. Run FFmpeg
-    split_success, _ = await _run_command(cmd, "ffmpeg") # Pass context if needed by helper
-
-    if not split_success:
-        logger.error(f"ffmpeg splitting failed: {original_path}. Cleanup partial dir.");
-        try: import shutil; shutil.rmtree(parts_dir)
-        except Exception as cl_err: logger.error(f"Failed cleanup {parts_dir}: {cl_err}")
-        if context and chat_id: await context.bot.send_message(chat_id, f"❌ Error splitting '{base_filename}'.")
-        return None
 
-    # 5. Find and return created parts
-    part_pattern_glob = os.path.join(parts_dir, f"{base_filename}_part*{file_ext}")
-    created_parts = sorted(glob.glob(part_pattern_glob))
-    if not created_parts: logger.error(f"No parts found: {part_pattern_glob}"); return None
-    num_parts_found = len(created_parts)
-    logger.info(f"ffmpeg split OK. Found {num_parts_found} parts.")
-    # Handle case where only one part is created
-    if num_parts_found == 1 and os.path.exists(original_path):
-        try:
-             orig_size = os.path.getsize(original_path); part_size = os.path.getsize(created_parts[0])
-             if abs(orig_size - part_size) < 1024*1024: logger.info("Only one part, similar size. Using original."); os.remove(created_parts[0]); os.rmdir(parts_dir); return [original_path]
-        except Exception as sp_err: logger.warning(f"Error check/clean single part: {sp_err}")
-    if context and chat_id:
-        try: await context.bot.send_message(chat_id, f"✅ Video splitting complete ({num_parts_found} parts).")
-        except Exception: pass
-    return created_parts
+    # 5. Run FFmpeg in the background so finished parts can be uploaded while it keeps splitting
+    part_queue = asyncio.Queue()
+    ffmpeg_task = asyncio.create_task(_run_ffmpeg_command(cmd, part_queue))
+    ffmpeg_task.add_done_callback(lambda _: part_queue.put_nowait(None)) # Ends the read loop below however ffmpeg exits
+    parts = []; done_msg_task = None; first_held = False
+    try:
+        # 6. ffmpeg lists each part on stdout once it has closed it; yield parts as they are listed.
+        #    Only a first part that could be the whole file (no keyframe plan, size near the original)
+        #    is held back until ffmpeg lists another part or exits, for the single-part check below
+        while (part_name := await part_queue.get()) is not None:
+            if not part_name: continue
+            part_path = os.path.join(parts_dir, os.fsdecode(part_name)); parts.append(part_path)
+            if len(parts) == 1 and not cut_points and _near_size(part_path, finfo.size): first_held = True; continue
+            if first_held: first_held = False; yield parts[0]
+            yield part_path
+
+        split_success, _ = ffmpeg_task.result()
+        if not split_success:
+            logger.error(f"ffmpeg splitting failed: {original_path}. Cleanup partial dir.");
+            try: await asyncio.to_thread(shutil.rmtree, parts_dir)
+            except Exception as cl_err: logger.error(f"Failed cleanup {parts_dir}: {cl_err}")
+            if context and chat_id: await context.bot.send_message(chat_id, f"❌ Error splitting '{base_filename}'.")
+            yield None; return
+
+        # 7. All parts are listed; only a lone first part can still be pending
+        num_parts_found = len(parts)
+        if not num_parts_found: logger.error(f"ffmpeg listed no parts in {parts_dir}"); yield None; return
+        logger.info(f"ffmpeg split OK. Found {num_parts_found} parts.")
+        # Handle case where only one part is created
+        if first_held:
+            try:
+                 part_st = os.stat(parts[0])
+                 if abs(finfo.size - part_st.st_size) < SINGLE_PART_TOLERANCE: logger.info("Only one part, similar size. Using original."); await asyncio.to_thread(shutil.rmtree, parts_dir); yield original_path; return
+            except Exception as sp_err: logger.warning(f"Error check/clean single part: {sp_err}")
+        done_msg_task = asyncio.create_task(_send_quietly(context, chat_id, f"✅ Video splitting complete ({num_parts_found} parts)."))
+        if first_held: yield parts[0]
+    finally:
+        # Consumer stopped early (e.g. upload failed): don't leave ffmpeg running
+        if not ffmpeg_task.done():
+            ffmpeg_task.cancel()
+            try: await ffmpeg_task
+            except asyncio.CancelledError: pass
+        if done_msg_task: await done_msg_task
+
+
+# --- Single Range Extraction (e.g. regenerating one part) ---
+async def _extract_range(path, start_s, dur_s, out):
+    """Copies [start_s, start_s + dur_s) of path into out without re-encoding. Returns success(bool).
+    -ss goes BEFORE -i so ffmpeg seeks in the demuxer instead of reading up to start_s."""
+    cmd = FFMPEG_BASE + (b'-y', b'-ss', str(start_s).encode(), b'-i', os.fsencode(path), b'-t', str(dur_s).encode(),
+                         b'-c', b'copy', b'-map', b'0', b'-avoid_negative_ts', b'make_zero', os.fsencode(out))
+    success, _ = await _run_ffmpeg_command(cmd)
+    return success
 
 
 # --- Main Splitting Logic ---
-async def split_if_needed(original_path, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None):
-    """ Checks size, splits video using ffmpeg if mode is Video, else fails large files. """
+async def iter_split_parts(original_path, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None, split_plan: dict | None = None):
+    """ Checks size, splits video using ffmpeg if mode is Video, else fails large files.
+    Async generator: yields upload-ready paths as they become available; a None item means failure.
+    If split_plan is given, split_plan['total_parts'] is set before the first part when the part count is
+    known up front (keyframe-planned split); fixed -segment_time splits leave it unset. """
     try:
-        if not os.path.exists(original_path): logger.error(f"Split check fail: Not found {original_path}"); return None
-        file_size = os.path.getsize(original_path); base_filename = os.path.basename(original_path)
-        _ , ext = os.path.splitext(base_filename); is_video = ext.lower() in VIDEO_EXTENSIONS
+        try: st = os.stat(original_path)
+        except FileNotFoundError: logger.error(f"Split check fail: Not found {original_path}"); yield None; return
+        base_filename = os.path.basename(original_path); ext = os.path.splitext(base_filename)[1]
+        finfo = _FInfo(original_path, base_filename, ext, st.st_size, st.st_mtime)
+        file_size = finfo.size; is_video = ext.lower() in VIDEO_EXTENSIONS
         upload_mode = context.bot_data.get('upload_mode', 'Document') if context else 'Document'
 
         logger.info(f"Check '{base_filename}': Size={file_size}, IsVideo={is_video}, Mode={upload_mode}")
-        if file_size <= SPLIT_CHECK_SIZE: logger.info("Size OK."); return [original_path]
+        if file_size <= SPLIT_CHECK_SIZE: logger.info("Size OK."); yield original_path; return
 
         if is_video and upload_mode == "Video":
             logger.info("Attempting dynamic duration ffmpeg video split...")
-            return await _split_video_dynamic_duration(original_path, context, chat_id)
+            async with aclosing(_split_video_dynamic_duration(finfo, context, chat_id, split_plan)) as split_parts:
+                async for part_path in split_parts: yield part_path
         else:
             d_dir = context.bot_data.get('download_dir', '/content') if context else '/content'
             logger.warning(f"Large file '{base_filename}' ({file_size/1024/1024:.1f}MB) in {d_dir} cannot split (not video or mode '{upload_mode}').")
             if context and chat_id:
                  try: await context.bot.send_message(chat_id, f"⚠️ File '{base_filename}' too large & cannot split for mode '{upload_mode}'.")
                  except Exception: pass
-            return None
+            yield None
     except Exception as e:
         logger.error(f"Error splitting check {original_path}: {e}", exc_info=True)
         if context and chat_id:
             try: await context.bot.send_message(chat_id, f"❌ Error check/split '{os.path.basename(original_path)}': {e}")
             except Exception: pass
-        return None
+        yield None
 
 
-# --- Cleanup Utility (Unchanged) ---
+async def split_if_needed(original_path, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None):
+    """ Like iter_split_parts, but waits for the whole split. Returns the list of parts, or None on failure. """
+    parts = [part_path async for part_path in iter_split_parts(original_path, context, chat_id)]
+    return parts if parts and None not in parts else None
+
+
+async def split_many(paths, context: ContextTypes.DEFAULT_TYPE | None, chat_id: int | None):
+    """ Runs split_if_needed over several files concurrently (limit: bot_data['split_concurrency']).
+    Returns one result (list of parts or None) per path, in input order. """
+    limit = context.bot_data.get('split_concurrency', SPLIT_CONCURRENCY) if context else SPLIT_CONCURRENCY
+    sem = asyncio.Semaphore(max(1, int(limit)))
+    async def split_one(path):
+        async with sem: return await split_if_needed(path, context, chat_id)
+    return await asyncio.gather(*(split_one(path) for path in paths))
+
+
+# --- Cleanup Utility ---
 async def cleanup_split_parts(original_path, parts):
-    """Deletes split parts and their directory, and optionally the original file."""
-    # ... (function body unchanged) ...
+    """Deletes split parts and their directory, and optionally the original file (in worker threads, off the event loop)."""
     if not parts or len(parts) <= 1: logger.debug(f"Cleanup skipped {original_path}."); return
-    parts_dir = os.path.dirname(parts[0]); logger.info(f"Cleaning up {len(parts)} parts in {parts_dir}"); deleted_parts_count = 0
+    parts_dir = os.path.dirname(parts[0]); logger.info(f"Cleaning up {len(parts)} parts in {parts_dir}")
     try:
-        for part_path in parts:
-            if os.path.exists(part_path):
-                try: os.remove(part_path); deleted_parts_count += 1
-                except Exception as e_part: logger.error(f"Failed delete part {part_path}: {e_part}")
-        logger.info(f"Deleted {deleted_parts_count} part files.")
-        if os.path.isdir(parts_dir):
-             try: os.rmdir(parts_dir); logger.info(f"Removed parts dir: {parts_dir}")
-             except OSError as e_dir: logger.warning(f"Could not remove parts dir {parts_dir}: {e_dir}")
-        if os.path.exists(original_path) and len(parts) > 1:
-             try: os.remove(original_path); logger.info(f"Deleted original: {original_path}")
-             except Exception as e_orig: logger.error(f"Failed delete original {original_path}: {e_orig}")
+        # The parts dir is owned by the split, so remove it in one tree walk (never touch anything else)
+        if not parts_dir.endswith("_parts"): logger.warning(f"Not a split parts dir, skip removal: {parts_dir}")
+        elif os.path.isdir(parts_dir):
+            failed = []
+            def on_rm_error(func, path, exc):
+                exc = exc if isinstance(exc, BaseException) else exc[1] # onexc gets the exception, onerror gets exc_info
+                failed.append(path); logger.error(f"Failed delete {path}: {exc}")
+            hook = {"onexc": on_rm_error} if sys.version_info >= (3, 12) else {"onerror": on_rm_error} # onerror is deprecated in 3.12
+            await asyncio.to_thread(shutil.rmtree, parts_dir, **hook)
+            if failed: logger.warning(f"Parts dir only partly removed ({len(failed)} failures): {parts_dir}")
+            else: logger.info(f"Removed parts dir: {parts_dir}")
+        try: await asyncio.to_thread(os.remove, original_path); logger.info(f"Deleted original: {original_path}")
+        except FileNotFoundError: pass # Already gone: nothing to do (saves a separate exists() stat)
+        except Exception as e_orig: logger.error(f"Failed delete original {original_path}: {e_orig}")
     except Exception as e: logger.error(f"Error cleanup {original_path}: {e}", exc_info=True)
 
 
 # --- Existing File/String Utilities ---
 def write_failed_downloads_to_file(failed_items, downloader_name, download_directory):
-    # ... (function body unchanged) ...
     if not failed_items: return None
     file_path = os.path.join(download_directory, f"failed_downloads_{downloader_name}.txt")
-    try: os.makedirs(download_directory, exist_ok=True); f=open(file_path, "w"); f.write(f"# Failed URLs for {downloader_name}\n"); [f.write(f"{item}\n") for item in failed_items]; f.close(); logger.info(f"Failed list saved: {file_path}"); return file_path
+    try:
+        os.makedirs(download_directory, exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(f"# Failed URLs for {downloader_name}\n"); f.write("\n".join(map(str, failed_items))); f.write("\n")
+        logger.info(f"Failed list saved: {file_path}"); return file_path
     except Exception as e: logger.error(f"Error writing failed file: {e}"); return None
 
 def clean_filename(filename):
-    # ... (function body unchanged) ...
     try: filename = urllib.parse.unquote(filename, encoding='utf-8', errors='replace')
     except Exception: pass
-    filename = filename.replace('%20', ' '); cleaned_filename = re.sub(r'[\\/:*?"<>|\[\]]', '_', filename) # Added brackets here too
-    cleaned_filename = re.sub(r'_+', '_', cleaned_filename); cleaned_filename = cleaned_filename.strip('._ '); cleaned_filename = cleaned_filename[:250]; return cleaned_filename if cleaned_filename else "downloaded_file"
+    filename = filename.replace('%20', ' ') # Brackets replaced too, in the same pass as the underscore collapse
+    cleaned_filename = _BAD_CHAR_RUNS_RE.sub('_', filename).strip('._ ')[:250]; return cleaned_filename or "downloaded_file"
 
 def extract_filename_from_url(url):
-    # ... (function body unchanged) ...
     try:
-        if not isinstance(url, str) or not url.lower().startswith(('http://', 'https://')): logger.warning(f"Skip invalid URL: {str(url)[:100]}"); return None
-        parsed_url = urllib.parse.urlparse(url); path = parsed_url.path; filename_raw = os.path.basename(path)
+        if not isinstance(url, str) or not url[:8].lower().startswith(('http://', 'https://')): logger.warning(f"Skip invalid URL: {str(url)[:100]}"); return None
+        parsed_url = urllib.parse.urlparse(url); path = parsed_url.path; filename_raw = path.rsplit('/', 1)[-1] # urlparse drops ;params from the last segment (keeps the extension)
         if not filename_raw and path != '/': segments = path.strip('/').split('/'); filename_raw = segments[-1] if segments else ''
         if not filename_raw: filename_raw = parsed_url.netloc.replace('.', '_') + "_file"
         decoded_filename = urllib.parse.unquote(filename_raw, encoding='utf-8', errors='replace'); return clean_filename(decoded_filename)
@@ -206,11 +539,11 @@ def apply_dot_style(filename):
     """Applies a specific style replacing common separators with dots."""
     # Replace sequences of space, underscore, or hyphen with a single dot
     # Includes underscores that might result from clean_filename's replacements
-    styled_name = re.sub(r'[ _-]+', '.', filename)
+    styled_name = _DOT_SEPARATORS_RE.sub('.', filename)
     # Remove any remaining brackets just in case (clean_filename should handle)
     styled_name = styled_name.replace('[', '').replace(']', '')
     # Collapse multiple dots into one
-    styled_name = re.sub(r'\.+', '.', styled_name)
+    styled_name = _DOTS_RE.sub('.', styled_name)
     # Remove leading/trailing dots
     styled_name = styled_name.strip('.')
     # Ensure filename is not empty after styling